@@ -15,7 +15,8 @@ The max limit is calculated as a percentage of the current rate - in this case
 :License: MIT
 
 **Dependencies:**
-  - **pysnmp:** SNMP library for Python (`pysnmp <https://pypi.org/project/pysnmp/>`_)
+  - **gufo_snmp:** Accelerated SNMP client library for Python (`gufo_snmp <https://pypi.org/project/gufo_snmp/>`_)
+  - **orjson:** Fast JSON library for Python (`orjson <https://pypi.org/project/orjson/>`_)
   - **routeros_api:** MikroTik RouterOS API for Python (`routeros_api <https://github.com/BenMenking/routeros_api>`_)
 
 **GitHub Repository:**
@@ -49,93 +50,190 @@ __license__ = "MIT"
 
 # Import system modules
 import argparse
+import asyncio
+import functools
 import os
 import logging
-import json
+import pathlib
+import socket
+import ssl
 
 # Import 3rd party modules
-from pysnmp.hlapi import (
-    getCmd,
-    SnmpEngine,
-    CommunityData,
-    UdpTransportTarget,
-    ContextData,
-    ObjectType,
-    ObjectIdentity
-)
+import orjson
+from gufo.snmp import SnmpError, SnmpVersion
+from gufo.snmp.aio import SnmpSession
 from routeros_api import RouterOsApiPool
+from routeros_api.exceptions import RouterOsApiCommunicationError
+from routeros_api.query import IsEqualQuery, OrQuery
 
 # Setup logging
 logging.basicConfig(
     level=os.getenv("LOG_LEVEL", "INFO"), format="%(levelname)s: %(message)s"
 )
 
-# Function to read configuration from file
+# TLS context for the RouterOS API connection. It matches the one routeros_api
+# builds itself for ssl_verify=False: certificate and hostname verification
+# stay disabled, as RouterOS typically presents a self-signed certificate
+ROUTEROS_SSL_CONTEXT = ssl.create_default_context()
+ROUTEROS_SSL_CONTEXT.check_hostname = False
+ROUTEROS_SSL_CONTEXT.verify_mode = ssl.CERT_NONE
+
+# Function to read configuration from file, parsed once and cached thereafter
+@functools.lru_cache(maxsize=1)
 def read_config():
-    with open('config.json', 'r', encoding='utf-8') as config_file:
-        configuration = json.load(config_file)
-    return configuration
+    return orjson.loads(pathlib.Path('config.json').read_bytes())
 
 
-# Function to convert bits per second to kilobits per second
+# Function to format bits per second as kilobits per second, as a string with
+# exactly two decimal places rounded half up, using integer arithmetic only
 def bits_to_kbps(bits_per_second):
-    return round(int(bits_per_second) / 1000, 2)
+    hundredths_kbps = (int(bits_per_second) + 5) // 10
+    return f"{hundredths_kbps // 100}.{hundredths_kbps % 100:02d}"
 
-# Function to subtract a percentage from a number
+# Function to subtract a percentage from a number, keeping the result an integer
 def subtract_percentage(number, percentage):
-    amount_to_subtract = number * (percentage / 100)
-    result = number - amount_to_subtract
-    return result
-
-# Function to perform SNMP get request
-def snmp_get(dsl_modem_ip, community_string, oid):
-    snmp_request = getCmd(
-        SnmpEngine(),
-        CommunityData(community_string),
-        UdpTransportTarget((dsl_modem_ip, 161)),
-        ContextData(),
-        ObjectType(ObjectIdentity(oid))
-    )
-    
-    error_indication, error_status, error_index, var_binds = next(snmp_request)
-    
-    if error_indication:
-        print(f"SNMP Error: {error_indication}")
-    else:
-        return var_binds[0][1]
-
-def get_queue_tree_attributes(api, queue_name):
+    return (int(number) * (100 - percentage)) // 100
+
+# SNMP request timeout in seconds and number of retries after a timeout, so a
+# single lost UDP datagram does not fail the whole run
+SNMP_TIMEOUT = 2.0
+SNMP_RETRIES = 2
+
+# Function to perform a single SNMPv2c get request for several OIDs over an
+# already open SNMP session, all OIDs travel as varbinds of the one PDU and
+# values are returned in the order requested
+async def snmp_get_many(snmp_session, oids):
+    var_binds = await snmp_session.get_many(oids)
+    return [var_binds.get(oid) for oid in oids]
+
+# Function to open an SNMPv2c session to the DSL modem's resolved (ip, port)
+# address and retrieve several OIDs, retrying the request on timeout
+async def fetch_dsl_rates(dsl_modem_addr, community_string, oids):
+    dsl_modem_ip, dsl_modem_port = dsl_modem_addr
+    async with SnmpSession(
+            addr=dsl_modem_ip,
+            port=dsl_modem_port,
+            community=community_string,
+            version=SnmpVersion.v2c,
+            timeout=SNMP_TIMEOUT
+            ) as snmp_session:
+        timeout_cause = None
+        for attempt in range(1 + SNMP_RETRIES):
+            try:
+                return await snmp_get_many(snmp_session, oids)
+            except TimeoutError as e:
+                # gufo_snmp raises a bare TimeoutError, any detail such as
+                # "connection refused" is only carried by its cause
+                timeout_cause = e.__cause__
+                logging.debug("No SNMP response from %s:%s, attempt %s of %s",
+                        dsl_modem_ip, dsl_modem_port, attempt + 1, 1 + SNMP_RETRIES)
+            except (SnmpError, OSError) as e:
+                print(f"SNMP Error: {e!r}")
+                return [None for oid in oids]
+
+    print(f"SNMP Error: no SNMP response from {dsl_modem_ip}:{dsl_modem_port} "
+          f"within {SNMP_TIMEOUT}s ({1 + SNMP_RETRIES} attempts)"
+          + (f": {timeout_cause}" if str(timeout_cause or "") else ""))
+    return [None for oid in oids]
+
+# Function to fetch the named queue tree entries in one request, keyed by name.
+# The router does the filtering by name and only returns the properties used
+def fetch_queue_tree(api, queue_names):
+    name_queries = [IsEqualQuery('name', queue_name) for queue_name in queue_names]
+    if len(name_queries) > 1:
+        name_queries = [OrQuery(*name_queries)]
+
+    queue_tree = api.get_resource('/queue/tree').call(
+        'print',
+        {'proplist': '.id,name,max-limit'},
+        additional_queries=name_queries
+        )
+
+    return {entry.get('name'): entry for entry in queue_tree}
+
+# Function to get an API connection from the pool with Nagle's algorithm
+# disabled, so the short RouterOS API sentences are not held back waiting
+# for delayed ACKs. The option can only be set once get_api() has connected,
+# so the login itself is still sent with Nagle enabled
+def get_routeros_api(api_pool):
+    api = api_pool.get_api()
+    # Relies on a routeros_api internal: the pool's socket is a SocketWrapper
+    # whose .socket attribute holds the underlying socket, as in the pinned
+    # RouterOS-api 0.17.0
+    api_pool.socket.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return api
+
+# Function to connect to RouterOS and fetch the queue tree, the blocking
+# routeros_api calls are run in a worker thread to keep the event loop free
+async def fetch_queue_tree_async(api_pool, queue_names):
+    api = await asyncio.to_thread(get_routeros_api, api_pool)
+    queue_tree = await asyncio.to_thread(fetch_queue_tree, api, queue_names)
+    return api, queue_tree
+
+# Function to retrieve the DSL rates and the RouterOS queue tree concurrently,
+# so the run waits for the slower of the two rather than their sum
+async def fetch_dsl_rates_and_queue_tree(dsl_modem_addr, community_string, oids, api_pool, queue_names):
+    return await asyncio.gather(
+        fetch_dsl_rates(dsl_modem_addr, community_string, oids),
+        fetch_queue_tree_async(api_pool, queue_names)
+        )
+
+def get_queue_tree_attributes(queue_tree, queue_name):
     # Get the specific queue by name
-    target_queue = api.get_resource('/queue/tree').get(name=queue_name)
+    target_queue = queue_tree.get(queue_name)
 
     # Check if the queue tree entry exists
     if target_queue:
-        queue_id = target_queue[0].get('id')
-        max_limit_value = target_queue[0].get('max-limit')
+        queue_id = target_queue.get('id')
+        max_limit_value = target_queue.get('max-limit')
 
         return queue_id, max_limit_value
     else:
         return None, None
 
-def set_queue_tree_max_limit(api, queue_name, max_limit):
-    # Get the specific queue by name
-    target_queue = api.get_resource('/queue/tree').get(name=queue_name)
+# Function to set the max limits of several queue tree entries, given as
+# {queue_name: (queue_id, max_limit)}. Every set is sent before any reply is
+# read, so the router answers them all within a single round trip. The sets
+# are not atomic: if one is rejected the others may still have been applied,
+# so each failure is logged and only the max limits actually applied are
+# returned, as {queue_name: max_limit}
+def set_queue_tree_max_limits(api, max_limits):
+    queue_tree_resource = api.get_resource('/queue/tree')
+
+    pending_sets = [
+        (queue_name, max_limit,
+            queue_tree_resource.call_async('set', {'id': str(queue_id), 'max-limit': str(int(max_limit))}))
+        for queue_name, (queue_id, max_limit) in max_limits.items()
+        ]
+
+    # Wait for each reply, noting any set the router rejected
+    applied_max_limits = {}
+    for queue_name, max_limit, pending_set in pending_sets:
+        try:
+            pending_set.get()
+        except RouterOsApiCommunicationError as e:
+            logging.error("Failed to set Queue \"%s\" Max Limit to %s: %s", queue_name, max_limit, e)
+        else:
+            applied_max_limits[queue_name] = max_limit
 
-    # Check if the queue tree entry exists
-    if target_queue:
-        queue_id = target_queue[0].get('id')
-        current_max_limit = target_queue[0].get('max-limit')
+    return applied_max_limits
 
+# Function to check whether a queue's max limit needs changing, given the id
+# and current max limit the caller already holds
+def queue_tree_max_limit_needs_update(queue_name, queue_id, current_max_limit, max_limit):
+    # Check if the queue tree entry exists
+    if queue_id is not None:
         # Check if the difference between the current and proposed max limits is greater than 2%
         if current_max_limit is not None and abs(int(current_max_limit) - int(max_limit)) / int(current_max_limit) > 0.02:
             logging.info("Setting Queue \"%s\" Max Limit to %s", queue_name, max_limit)
-            api.get_resource('/queue/tree').set(id=str(queue_id), max_limit=str(max_limit))
+            return True
         else:
             logging.info("Queue \"%s\" Max Limit is within +/- 2%% (Current: %skbps vs Proposed: %skbps), no change needed",
                             queue_name, bits_to_kbps(current_max_limit), bits_to_kbps(max_limit))
+            return False
     else:
         logging.error("Queue ID or Max Limit is not set")
-        return
+        return False
 
 def main(args):
     """ Main entry point of the app """
@@ -158,24 +256,34 @@ def main(args):
             username=USERNAME,
             password=PASSWORD,
             plaintext_login=True,
-            use_ssl=True,
-            ssl_verify=False,
-            ssl_verify_hostname=False
+            ssl_context=ROUTEROS_SSL_CONTEXT
             )
 
-    # Get an API connection from the pool
-    api = api_pool.get_api()
-
     # SNMP Configuration
     DSL_MODEM_IP = os.getenv('DSL_MODEM_IP', config['snmp']['dsl_modem_ip'])
     SNMP_COMMUNITY_STRING = os.getenv('SNMP_COMMUNITY_STRING', config['snmp']['community_string'])
     SNMP_OID_DOWNSTREAM = os.getenv('SNMP_OID_DOWNSTREAM', config['snmp']['snmp_oid_downstream'])
     SNMP_OID_UPSTREAM = os.getenv('SNMP_OID_UPSTREAM', config['snmp']['snmp_oid_upstream'])
 
-    # Retrieve and display downstream attainable rate
+    # Prepare the OIDs once, in the numeric form without a leading dot that
+    # gufo_snmp expects, rather than per request
+    SNMP_OIDS = [oid.strip().lstrip('.') for oid in (SNMP_OID_DOWNSTREAM, SNMP_OID_UPSTREAM)]
+
+    # Retrieve downstream and upstream attainable rates in a single request,
+    # while connecting to RouterOS and fetching the queue tree at the same time
     try:
-        dsl_downstream_act_rate = snmp_get(DSL_MODEM_IP, SNMP_COMMUNITY_STRING, SNMP_OID_DOWNSTREAM)
-        dsl_upstream_act_rate = snmp_get(DSL_MODEM_IP, SNMP_COMMUNITY_STRING, SNMP_OID_UPSTREAM)
+        # Resolve the DSL modem address once, DSL_MODEM_IP may be a hostname
+        dsl_modem_addr = socket.getaddrinfo(DSL_MODEM_IP, 161, socket.AF_INET, socket.SOCK_DGRAM)[0][4]
+
+        (dsl_downstream_act_rate, dsl_upstream_act_rate), (api, mt_queue_tree) = asyncio.run(
+            fetch_dsl_rates_and_queue_tree(
+                dsl_modem_addr,
+                SNMP_COMMUNITY_STRING,
+                SNMP_OIDS,
+                api_pool,
+                [DOWNLOAD_QUEUE_NAME, UPLOAD_QUEUE_NAME]
+                )
+            )
     except Exception as e:
         print(f"Error: {e}")
         exit(1)
@@ -205,8 +313,8 @@ def main(args):
             mt_up_queue_set_max_limit
             )
 
-    mt_queue_tree_download_id, mt_queue_tree_download_max_limit_value = get_queue_tree_attributes(api, DOWNLOAD_QUEUE_NAME)
-    mt_queue_tree_upload_id, mt_queue_tree_upload_max_limit_value = get_queue_tree_attributes(api, UPLOAD_QUEUE_NAME)
+    mt_queue_tree_download_id, mt_queue_tree_download_max_limit_value = get_queue_tree_attributes(mt_queue_tree, DOWNLOAD_QUEUE_NAME)
+    mt_queue_tree_upload_id, mt_queue_tree_upload_max_limit_value = get_queue_tree_attributes(mt_queue_tree, UPLOAD_QUEUE_NAME)
 
     if mt_queue_tree_download_id is not None and mt_queue_tree_upload_id is not None:
         logging.debug("Download/Upload Queue IDs: %s/%s", mt_queue_tree_download_id, mt_queue_tree_upload_id)
@@ -218,16 +326,37 @@ def main(args):
     else:
         logging.warning("Queue Tree entry not found.")
 
-    # Set Download Queue
-    set_queue_tree_max_limit(api, DOWNLOAD_QUEUE_NAME, mt_down_queue_set_max_limit)
+    # Work out which of the Download and Upload Queues need a new max limit
+    mt_queue_tree_set_max_limits = {}
 
-    # Set Upload Queue
-    set_queue_tree_max_limit(api, UPLOAD_QUEUE_NAME, mt_up_queue_set_max_limit)
+    if queue_tree_max_limit_needs_update(DOWNLOAD_QUEUE_NAME, mt_queue_tree_download_id,
+            mt_queue_tree_download_max_limit_value, mt_down_queue_set_max_limit):
+        mt_queue_tree_set_max_limits[DOWNLOAD_QUEUE_NAME] = (mt_queue_tree_download_id, mt_down_queue_set_max_limit)
 
-    # Display results
+    if queue_tree_max_limit_needs_update(UPLOAD_QUEUE_NAME, mt_queue_tree_upload_id,
+            mt_queue_tree_upload_max_limit_value, mt_up_queue_set_max_limit):
+        mt_queue_tree_set_max_limits[UPLOAD_QUEUE_NAME] = (mt_queue_tree_upload_id, mt_up_queue_set_max_limit)
+
+    # Set both queues together
+    mt_queue_tree_applied_max_limits = set_queue_tree_max_limits(api, mt_queue_tree_set_max_limits)
 
-    mt_queue_tree_download_applied_max_limit_value = int(get_queue_tree_attributes(api, DOWNLOAD_QUEUE_NAME)[1])
-    mt_queue_tree_upload_applied_max_limit_value = int(get_queue_tree_attributes(api, UPLOAD_QUEUE_NAME)[1])
+    # The applied max limits are those just set, or the current ones where no
+    # change was needed or the set was rejected
+    mt_queue_tree_download_applied_max_limit_value = mt_queue_tree_applied_max_limits.get(
+        DOWNLOAD_QUEUE_NAME, mt_queue_tree_download_max_limit_value)
+    mt_queue_tree_upload_applied_max_limit_value = mt_queue_tree_applied_max_limits.get(
+        UPLOAD_QUEUE_NAME, mt_queue_tree_upload_max_limit_value)
+
+    # Only read the applied limits back from the router when debugging
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        mt_queue_tree = fetch_queue_tree(api, [DOWNLOAD_QUEUE_NAME, UPLOAD_QUEUE_NAME])
+
+        logging.debug("Download/Upload Queue VERIFIED Max Limits: %s/%s",
+            get_queue_tree_attributes(mt_queue_tree, DOWNLOAD_QUEUE_NAME)[1],
+            get_queue_tree_attributes(mt_queue_tree, UPLOAD_QUEUE_NAME)[1]
+            )
+
+    # Display results
 
     if mt_queue_tree_download_applied_max_limit_value is not None and mt_queue_tree_upload_applied_max_limit_value is not None:
         logging.info("Download/Uploads Queue APPLIED Max Limits: %s/%s (%s/%skbps)",